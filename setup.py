@@ -23,9 +23,10 @@ setuptools.setup(
     install_requires=[
         'markdown',
         'graphviz',
-        'pandas',
+        'numpy',
+        'pandas>=1.5',
+        'pyarrow',
         'pillow',
-        'multipledispatch',
         'loguru'
     ],
 )
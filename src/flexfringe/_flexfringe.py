@@ -1,34 +1,140 @@
 import os
 import subprocess
 import shutil
-import time
+import threading
 from pathlib import Path
 from PIL import Image
 import graphviz as graphviz
 import io
+import numpy as np
 import pandas as pd
-from multipledispatch import dispatch
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow.csv import read_csv, ReadOptions, ParseOptions, ConvertOptions
 from pandas import DataFrame
-from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp, mkstemp, TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import warnings
 from loguru import logger
 
 logger.disable("flexfringe")
 
+# Options for writing dataframes as flexfringe tracefiles. The pandas index is not part of the traces,
+# and writing in chunks keeps pandas from formatting the whole frame in memory at once.
+_CSV_OPTIONS = dict(index=False, header=True, chunksize=100_000, lineterminator="\n")
+
+# Parquet metadata key holding the mtime, ctime and size of the result file a sidecar was parsed from
+_SIDECAR_STAMP_KEY = b"flexfringe.result_stat"
+
+
+# Executables found in PATH by _resolve
+_resolved = dict()
+
+
+def _resolve(name: str):
+    """
+    Looks up an executable in PATH, remembering where it was found so PATH is only scanned once per executable.
+    Misses are not remembered, so an executable installed or added to PATH later is still picked up
+    """
+    if name not in _resolved:
+        path = shutil.which(name)
+        if path is None:
+            return None
+        _resolved[name] = path
+    return _resolved[name]
+
+
+def _in_notebook():
+    """
+    Whether we are running inside a Jupyter kernel, where images can be displayed inline
+    """
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+
+    shell = get_ipython()
+    return shell is not None and "IPKernelApp" in shell.config
+
+
+def _write_csv(df: DataFrame, path: str, errors: list):
+    """
+    Writes df to path in csv format, stopping quietly if the reader goes away.
+    Any other error is added to errors, so it can be raised again in the calling thread.
+    """
+    try:
+        df.to_csv(path, **_CSV_OPTIONS)
+    except BrokenPipeError:
+        logger.debug(f"flexfringe stopped reading from {path} before the dataframe was fully written")
+    except BaseException as e:
+        errors.append(e)
+
+
+@contextmanager
+def _dataframe_tracefile(df: DataFrame, stream=False):
+    """
+    Makes a dataframe available to flexfringe as a csv tracefile.
+    flexfringe only has loaders for abbadingo and csv input, so csv is the format used here.
+
+    By default the csv is written to a temporary file. With stream, and where named pipes are supported,
+    it is instead streamed through a fifo from a background thread while flexfringe reads it,
+    so the data never has to be written to disk. This only works if flexfringe opens the input once
+    and reads it front to back without seeking; a second open would block forever.
+    Either way the input is removed afterwards, also when flexfringe fails.
+
+    :param df: Pandas dataframe to write
+    :param stream: whether to stream the csv through a named pipe instead of a temporary file
+    :return: the path flexfringe should read the traces from
+    """
+    # flexfringe writes its output files next to the tracefile, so the directory is only removed when empty
+    tmp_dir = mkdtemp(prefix="flexfringe-")
+    path = os.path.join(tmp_dir, "traces.csv")
+
+    writer = None
+    errors = []
+    try:
+        if stream and hasattr(os, "mkfifo"):
+            os.mkfifo(path)
+            writer = threading.Thread(target=_write_csv, args=(df, path, errors), daemon=True)
+            writer.start()
+        else:
+            df.to_csv(path, **_CSV_OPTIONS)
 
-class FlexFringe:
-    # namespace for multipledispatch
-    namespace = dict()
+        yield path
+    finally:
+        # If flexfringe exited without opening the pipe, the writer is still blocked on opening it.
+        # Opening and closing the read end unblocks it, after which its writes fail with a broken pipe.
+        while writer is not None and writer.is_alive():
+            os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            writer.join(timeout=0.1)
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(tmp_dir)
+        except OSError:
+            pass
 
-    def __init__(self, flexfringe_path=None, **kwargs):
+    # A failed writer closes the pipe early, so flexfringe only saw part of the dataframe
+    if errors:
+        raise errors[0]
+
+
+class FlexFringe:
+    def __init__(self, flexfringe_path=None, stream_dataframes=False, **kwargs):
         """
         Initialize the flexfringe wrapper
         :param flexfringe_path: Path to flexfringe, or None to autodetect (flexfringe must be in PATH)
+        :param stream_dataframes: Pass dataframes to flexfringe through a named pipe instead of a temporary file.
+                                  Only use this with flexfringe builds that read their input once, without seeking
         :param kwargs: Any keyword arguments will be passed to flexfringe in the form of --key=value
         """
 
         if flexfringe_path is None:
-            self.path = shutil.which("flexfringe")
+            self.path = _resolve("flexfringe")
         else:
             self.path = flexfringe_path
 
@@ -36,10 +142,27 @@ class FlexFringe:
             raise RuntimeError(
                 "Could not find flexfringe executable. Please put it in your PATH or provide flexfringe_path in the constructor")
 
+        self.stream_dataframes = stream_dataframes
         self.tracefile = None
         self.resultfile = None
 
+        # (path, contents) of the last dot file rendered by show()
+        self._dot_cache = None
+        # (key, dataframe) of the last result read through the result property
+        self._result_cache = None
+
         self.kwargs = kwargs
+        # self.kwargs formatted as flags, together with the copy of self.kwargs they were formatted from
+        self._base_kwargs = dict(kwargs)
+        self._base_flags = self._format_kwargs(**kwargs)
+
+    @property
+    def result(self) -> DataFrame:
+        """
+        The output of the last prediction, read again from its result file without re-running flexfringe.
+        The parsed dataframe is kept, so reading this repeatedly only parses the result file once.
+        """
+        return self._parse_flexfringe_result(use_cache=True)
 
     @property
     def dot_out(self) -> Path:
@@ -64,184 +187,267 @@ class FlexFringe:
 
         return tmp
 
-    @dispatch(DataFrame, namespace=namespace)
-    def fit(self, df: DataFrame, **kwargs):
-        """
-        Convenience method of fit which takes a pandas dataframe.
-        First it writes the dataframe to a temporary csv file, and then it calls flexfringe like normal.
-        Finally, it cleans up the temporary file
-
-        :param df: Pandas dataframe containing the data to learn a state machine from
-        :param kwargs: other parameters to be passed to flexfringe
-        """
-        with NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
-            df.to_csv(file)
-            file.close()
-            self.fit(file.name, **kwargs)
-            os.remove(file.name)
-
-    @dispatch(object, namespace=namespace)
-    def fit(self, tracefile, **kwargs):
+    def fit(self, tracefile, output_file=None, output_format=None, **kwargs):
         """
         Calls flexfringe on the file path specified by tracefile
         kwargs are passed through to flexfringe in the form of --key=value
 
-        :param tracefile: Path to the trace file to load. Can be either in abbadingo or csv format
+        For convenience, tracefile can also be a pandas dataframe.
+        It is then passed to flexfringe as a temporary csv file, which is cleaned up afterwards.
+
+        If the model is saved with a different name (e.g. through the outputfile flag),
+        pass that name as output_file so the right output file is checked for.
+
+        :param tracefile: Path to the trace file to load. Can be either in abbadingo or csv format, or a pandas dataframe
+        :param output_file: Path to where the model is saved
+        :param output_format: Format the model is saved in, e.g. "json" or "dot"
         :param kwargs: other parameters to be passed to flexfringe
         """
-        # Use the kwargs passed to this function as overrides for the ones specified in the constructor
-        all_kwargs = dict(self.kwargs)
-        for k, v in kwargs.items():
-            all_kwargs[k] = v
-        flags = self._format_kwargs(**all_kwargs)
+        if isinstance(tracefile, DataFrame):
+            with _dataframe_tracefile(tracefile, self.stream_dataframes) as path:
+                return self.fit(path, output_file, output_format, **kwargs)
+
+        flags = self._call_flags(**kwargs)
 
         command = [tracefile] + flags
 
         self._run(command)
 
         self.tracefile = tracefile
+        self._dot_cache = None
 
-        try:
-            with self.dot_out.open('r') as fh:
-                dot_content = fh.read()
-            with self.json_out.open('r') as fh:
-                json_content = fh.read()
-        except FileNotFoundError as e:
-            raise RuntimeError(f"Error running FlexFringe: no output file found: {e.filename}")
-        
-    @dispatch(object, namespace=namespace)
-    def fit(self, tracefile, output_file=None, output_format=None, **kwargs):
+        if output_file is not None:
+            model = output_file + '.final.' + output_format
+
+            if not os.path.isfile(model):
+                raise RuntimeError(f"Error running FlexFringe: no output file found: {model}")
+        else:
+            # Resolving the output files raises a RuntimeError if flexfringe did not write them
+            _ = self.dot_out, self.json_out
+
+    def predict(self, tracefile, apta_file=None, **kwargs):
         """
-        Hacky function for learning a model from the tracefile and saving the model
-        with a different name.
+        Runs flexfringe in predict mode, using the provided apta file,
+        or the aptafile generated by a previous call to fit if none is given
 
-        kwargs are passed through to flexfringe in the form of --key=value
+        For convenience, tracefile can also be a pandas dataframe, which is written to csv and passed to flexfringe.
 
-        :param tracefile: Path to the trace file to load. Can be either in abbadingo or csv format
-        :param output_file: Path to where the model is saved
+        :param tracefile: the tracefile to run predictions on, or a pandas dataframe
+        :param apta_file: the apta file to use for predictions
         :param kwargs: other parameters to be passed to flexfringe
+        :return: A dataframe with the output from flexfringe
         """
-        # Use the kwargs passed to this function as overrides for the ones specified in the constructor
-        all_kwargs = dict(self.kwargs)
-        for k, v in kwargs.items():
-            all_kwargs[k] = v
-        flags = self._format_kwargs(**all_kwargs)
+        if isinstance(tracefile, DataFrame):
+            with _dataframe_tracefile(tracefile, self.stream_dataframes) as path:
+                return self.predict(path, apta_file, **kwargs)
 
-        command = [tracefile] + flags
+        flags = self._call_flags(**kwargs)
+
+        if apta_file is None:
+            command = [tracefile, "--mode=predict", f"--aptafile={self.json_out}"] + flags
+        else:
+            command = [tracefile, "--mode=predict", f"--aptafile={apta_file}"] + flags
+            self.tracefile = apta_file.split('.ff')[0] # training file is used for writing prediction results
 
         self._run(command)
 
-        self.tracefile = tracefile
+        return self._parse_flexfringe_result()
 
-        model = output_file + '.final.' + output_format
-        
-        try:
-            with open(model, 'r') as fh:
-                _ = fh.read()
-        except FileNotFoundError as e:
-            raise RuntimeError(f"Error running FlexFringe: no output file found: {e.filename}")
+    def predict_batch(self, tracefiles, apta_file=None, max_workers=None, semaphore=None, **kwargs):
+        """
+        Runs predict on several tracefiles concurrently, with one flexfringe process per tracefile.
+        Each run uses its own link to the apta file, so the prediction results do not overwrite each other.
+
+        :param tracefiles: the tracefiles to run predictions on. Like in predict, these can also be pandas dataframes
+        :param apta_file: the apta file to use for predictions, or None to use the one generated by a previous call to fit
+        :param max_workers: maximum number of worker threads, defaults to the ThreadPoolExecutor default
+        :param semaphore: optional limit on the number of flexfringe processes running at once, to throttle memory use.
+                          Either a count, or a threading.Semaphore to share the limit with other calls
+        :param kwargs: other parameters to be passed to flexfringe
+        :return: A dataframe with the output from flexfringe for all tracefiles, keyed by tracefile path,
+                 or by position in tracefiles for dataframes
+        """
+        tracefiles = [tracefile if isinstance(tracefile, DataFrame) else str(tracefile) for tracefile in tracefiles]
+        if not tracefiles:
+            raise ValueError("predict_batch needs at least one tracefile")
 
+        apta_file = Path(self.json_out if apta_file is None else apta_file).resolve()
+        flags = self._call_flags(**kwargs)
 
-    @dispatch(DataFrame)
-    def predict(self, df: DataFrame, **kwargs):
-        """
-        Convenience method for predict which takes a pandas dataframe
+        if isinstance(semaphore, bool) or (isinstance(semaphore, int) and semaphore < 1):
+            raise ValueError(f"semaphore must be a count of at least 1 or a threading.Semaphore, not {semaphore!r}")
+        if isinstance(semaphore, int):
+            semaphore = threading.BoundedSemaphore(semaphore)
 
-        :param df: The pandas dataframe to write to csv and pass to flexfringe
-        :param kwargs: other parameters to be passed to flexfringe
-        :return: A dataframe with the output from flexfringe
+        def predict_one(tracefile):
+            if semaphore is None:
+                return self._predict_isolated(tracefile, apta_file, flags)
+            with semaphore:
+                return self._predict_isolated(tracefile, apta_file, flags)
+
+        # Threads are enough here, the work happens in the flexfringe subprocesses
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            dfs = list(executor.map(predict_one, tracefiles))
+
+        keys = [i if isinstance(tracefile, DataFrame) else tracefile for i, tracefile in enumerate(tracefiles)]
+        return pd.concat(dfs, keys=keys)
+
+    def _predict_isolated(self, tracefile, apta_file: Path, flags):
         """
-        with NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
-            df.to_csv(file)
-            file.close()
-            df_out = self.predict(file.name, **kwargs)
-            os.remove(file.name)
-            return df_out
-    
-    @dispatch(object)
-    def predict(self, tracefile, **kwargs):
+        Runs a single prediction in its own temporary directory, without touching self.tracefile.
+        flexfringe writes the prediction result next to the apta file, so the apta file is linked in there first.
         """
-        Runs flexfringe in predict mode, using the aptafile generated by a previous call to fit
+        if isinstance(tracefile, DataFrame):
+            with _dataframe_tracefile(tracefile, self.stream_dataframes) as path:
+                return self._predict_isolated(path, apta_file, flags)
 
-        :param tracefile: the tracefile to run predictions on
-        :param kwargs: other parameters to be passed to flexfringe
-        :return: A dataframe with the output from flexfringe
-        """
-        # Use the kwargs passed to this function as overrides for the ones specified in the constructor
-        all_kwargs = dict(self.kwargs)
-        for k, v in kwargs.items():
-            all_kwargs[k] = v
-        flags = self._format_kwargs(**all_kwargs)
+        with TemporaryDirectory(prefix="flexfringe-") as tmp_dir:
+            apta_link = Path(tmp_dir) / apta_file.name
+            try:
+                os.symlink(apta_file, apta_link)
+            except OSError:
+                shutil.copyfile(apta_file, apta_link)
 
-        command = [tracefile, "--mode=predict", f"--aptafile={self.json_out}"] + flags
+            self._run([tracefile, "--mode=predict", f"--aptafile={apta_link}"] + flags)
 
-        self._run(command)
+            result_file = Path(f"{apta_link}.result.csv")
+            if not result_file.is_file():
+                raise RuntimeError(f"Could not find valid flexfringe output file at: {str(result_file)}")
 
-        return self._parse_flexfringe_result()
+            return self._parse_flexfringe_result(result_file)
 
-    @dispatch(str, str)
-    def predict(self, tracefile:str, apta_file:str, **kwargs):
+    def _parse_flexfringe_result(self, result_file: Path = None, use_cache=False):
         """
-        Runs flexfringe in predict mode, using the provided apta file
+        Parses a flexfringe prediction result into a dataframe.
+        With use_cache, the last parsed result is kept, and returned again as long as the result file did not change.
+        The parsed result is then also stored in a parquet file next to the result file, which a later process
+        loads instead of parsing the result file again, as long as the result file has the same mtime, ctime and size.
 
-        :param tracefile: the tracefile to run predictions on
-        :param apta_file: the apta file to use for predictions
-        :param kwargs: other parameters to be passed to flexfringe
+        predict has just rewritten the result file, so it parses without either cache; only the result property uses them.
+
+        :param result_file: the result file to parse, defaults to the result of the current tracefile
+        :param use_cache: whether to look up and remember the parsed result
         :return: A dataframe with the output from flexfringe
         """
-        # Use the kwargs passed to this function as overrides for the ones specified in the constructor
-        all_kwargs = dict(self.kwargs)
-        for k, v in kwargs.items():
-            all_kwargs[k] = v
-        flags = self._format_kwargs(**all_kwargs)
-        
-        command = [tracefile, "--mode=predict", f"--aptafile={apta_file}"] + flags
-        self.tracefile = apta_file.split('.ff')[0] # training file is used for writing prediction results
-        self._run(command)
+        result_out = self.result_out if result_file is None else result_file
+
+        if not use_cache:
+            return self._read_flexfringe_result(result_out)
+
+        # The ctime can not be set by hand, so it also catches rewrites that keep the mtime and size
+        stat = result_out.stat()
+        key = (str(result_out), stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size)
+        if self._result_cache is None or self._result_cache[0] != key:
+            self._result_cache = (key, self._load_flexfringe_result(result_out, key))
+
+        # DataFrame.copy does not copy the lists and arrays inside the sequence columns, so copy those too,
+        # otherwise changing them in one result would change the cached one
+        cached = self._result_cache[1]
+        df = cached.copy(deep=False)
+        for column in ("abbadingo trace", "state sequence", "score sequence"):
+            df[column] = pd.Series([value.copy() for value in cached[column]], index=cached.index, dtype=object)
+        return df
 
-        return self._parse_flexfringe_result()
+    def _load_flexfringe_result(self, result_out: Path, key: tuple):
+        sidecar = Path(f"{result_out}.parquet")
+        # The sidecar is stamped with the same mtime, ctime and size as the in-memory cache key.
+        # File timestamps are too coarse to compare the sidecar's own mtime against,
+        # and copies or restores can keep the original mtime
+        stamp = ",".join(str(part) for part in key[1:]).encode()
+
+        try:
+            if (pq.read_schema(sidecar).metadata or {}).get(_SIDECAR_STAMP_KEY) == stamp:
+                df = pq.read_table(sidecar).to_pandas()
+                # Parquet hands lists back as numpy arrays, turn these back into lists like _read_flexfringe_result does
+                for column in ("abbadingo trace", "state sequence"):
+                    df[column] = df[column].map(list)
+                return df
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # A damaged sidecar is just a cache miss, it is overwritten below
+            logger.debug(f"Could not read parsed result from {sidecar}: {e}")
+
+        df = self._read_flexfringe_result(result_out)
+
+        table = pa.Table.from_pandas(df)
+        table = table.replace_schema_metadata({**table.schema.metadata, _SIDECAR_STAMP_KEY: stamp})
+
+        # Write to a temporary name first and move it into place, so readers never see a partial sidecar
+        tmp_path = None
+        try:
+            fd, tmp_path = mkstemp(prefix=f"{sidecar.name}.", suffix=".tmp", dir=sidecar.parent)
+            os.close(fd)
+            pq.write_table(table, tmp_path, compression="zstd")
+            os.replace(tmp_path, sidecar)
+        except Exception as e:
+            logger.debug(f"Could not write parsed result to {sidecar}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return df
 
-    def _parse_flexfringe_result(self):
-        df = pd.read_csv(self.result_out, delimiter=";")
-        df.columns = [column.strip() for column in df.columns]
+    def _read_flexfringe_result(self, result_out: Path):
+        # flexfringe pads the header with spaces, so read it ourselves to key the schema on the stripped names
+        with result_out.open('r') as fh:
+            columns = [column.strip() for column in fh.readline().split(";")]
+
+        df = read_csv(
+            result_out,
+            read_options=ReadOptions(column_names=columns, skip_rows=1),
+            parse_options=ParseOptions(delimiter=";"),
+            convert_options=ConvertOptions(column_types={
+                "row nr": pa.int64(),
+                "abbadingo trace": pa.string(),
+                "state sequence": pa.string(),
+                "score sequence": pa.string(),
+                "sum scores": pa.float64(),
+                "mean scores": pa.float64(),
+                "min score": pa.float64(),
+            })
+        ).to_pandas()
 
         # Parse abbadingo traces
-        abd_traces = df['abbadingo trace']
-        abd_traces = abd_traces.apply(lambda x: x.strip().strip("\""))
+        abd_traces = df['abbadingo trace'].str.strip().str.strip("\"")
+        abd_parts = abd_traces.str.split(" ", n=2, expand=True).reindex(columns=range(3))
 
-        abd_type = []
-        abd_len = []
-        abd_trc = []
+        abd_type = abd_parts[0]
+        abd_len = abd_parts[1]
+        abd_trc = abd_parts[2].fillna("").astype(str).str.split()
 
-        for abd_trace in abd_traces:
-            parts = abd_trace.split(" ")
-            abd_type.append(parts[0])
-            abd_len.append(parts[1])
-            abd_trc.append(parts[2:])
+        # Replace the raw trace column by its three parts in a single pass, keeping them at its position
+        columns = list(df.columns)
+        position = columns.index("abbadingo trace")
+        columns[position:position + 1] = ["abbadingo type", "abbadingo length", "abbadingo trace"]
 
-        df = df.drop(columns=["abbadingo trace"])
-        df.insert(1, "abbadingo type", abd_type)
-        df.insert(2, "abbadingo length", abd_len)
-        df.insert(3, "abbadingo trace", abd_trc)
+        df = df.assign(**{
+            "abbadingo type": abd_type,
+            "abbadingo length": abd_len,
+            "abbadingo trace": abd_trc,
+        })[columns]
 
         # Parse state sequences
-        df['state sequence'] = df['state sequence'] \
-            .apply(lambda x: x.strip().strip("[").strip("]").split(","))
+        df['state sequence'] = df['state sequence'].str.strip(" []").str.split(",")
 
-        # Parse score sequence
-        df['score sequence'] = df['score sequence'] \
-            .apply(lambda x: [float(val) for val in x.strip().strip("[").strip("]").split(",")])
+        # Parse score sequence. numpy parses the scores of all rows in one go, after which they are split up per row again
+        scores = df['score sequence'].str.strip(" []")
+        lengths = (scores.str.count(",") + 1).where(scores.str.len() > 0, 0).to_numpy()
+        values = np.fromstring(",".join(scores[lengths > 0]), sep=",", dtype=np.float64)
+        if len(values) != lengths.sum():
+            raise ValueError("Could not parse the score sequences in the flexfringe output")
 
-        # And the rest of the score columns
-        df['sum scores'] = df['sum scores'].astype(float)
-        df['mean scores'] = df['mean scores'].astype(float)
-        df['min score'] = df['min score'].astype(float)
+        df['score sequence'] = pd.Series(np.split(values, np.cumsum(lengths)[:-1]) if len(df) else [],
+                                         index=df.index, dtype=object)
 
         return df
 
     def _run(self, command=None):
         """
         Wrapper to call the flexfringe binary
+
+        flexfringe's interactive mode (--mode=interactive) is for choosing merges by hand, and there is no
+        stdin protocol for sending it fit or predict commands. Every run takes its inputs from the command line
+        and exits, so each call starts a new process.
         """
 
         if command is None:
@@ -249,40 +455,65 @@ class FlexFringe:
 
         full_cmd = ["flexfringe"] + command
         logger.debug(f"Running: {' '.join(full_cmd)}")
-        result = subprocess.run([self.path] + command, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True)
-        logger.debug(f"Flexfringe exit code: {result.returncode}")
-        logger.info(f"Flexfringe stdout:\n{result.stdout}")
-        logger.info(f"Flexfringe stderr:\n{result.stderr}")
+        # Log the output line by line as it is produced, instead of buffering all of it until flexfringe exits.
+        # stderr is merged into stdout so a single pipe has to be drained.
+        with subprocess.Popen([self.path] + command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, bufsize=1) as proc:
+            for line in proc.stdout:
+                logger.info(f"Flexfringe: {line.rstrip()}")
+        logger.debug(f"Flexfringe exit code: {proc.returncode}")
 
     def show(self, format="png"):
         """
         Renders the final state machine generated by flexfringe using graphviz
-        and displays it using pillow.
+        and displays it using pillow, or inline when running in a Jupyter notebook.
 
         :param format: a file format supported by both graphviz and pillow.
         """
-        if shutil.which("dot") is None:
+        if _resolve("dot") is None:
             raise RuntimeError("pfind dot executable in path. Displaying graphs will not work. "
                                "Please install graphviz: https://graphviz.org/download/")
 
         if self.dot_out is None:
             raise RuntimeError("No output available, run \"fit\" first")
         else:
-            with Path(self.dot_out).open('r') as in_file:
-                g = graphviz.Source(
-                    in_file.read()
-                )
+            dot_out = self.dot_out
+            if self._dot_cache is None or self._dot_cache[0] != dot_out:
+                self._dot_cache = (dot_out, dot_out.read_text())
+
+            g = graphviz.Source(self._dot_cache[1])
+
+            img = Image.open(io.BytesIO(g.pipe(format=format)))
+            # Decode right away instead of lazily, so the image is complete before it is handed to the viewer
+            img.load()
+
+            if _in_notebook():
+                from IPython.display import display
+                display(img)
+            else:
+                img.show()
+
+    def _call_flags(self, **kwargs):
+        """
+        Builds the command line flags for a single call to flexfringe.
+        The kwargs passed to this function override the ones specified in the constructor.
+
+        :param kwargs: the kwargs passed to fit or predict
+        :return: a list of command line args for flexfringe, which may be shared and should not be modified
+        """
+        if self.kwargs != self._base_kwargs:
+            # self.kwargs was changed after construction
+            self._base_kwargs = dict(self.kwargs)
+            self._base_flags = self._format_kwargs(**self.kwargs)
 
-            data = io.BytesIO()
-            data.write(g.pipe(format=format))
-            data.seek(0)
+        if not kwargs:
+            return self._base_flags
 
-            img = Image.open(data)
-            img.show()
+        if self.kwargs.keys().isdisjoint(kwargs):
+            # Nothing is overridden, so the constructor flags can be reused as they are
+            return self._base_flags + self._format_kwargs(**kwargs)
 
-            # Need to give it time to open image viewer :/
-            time.sleep(1)
+        return self._format_kwargs(**{**self.kwargs, **kwargs})
 
     def _format_kwargs(self, **kwargs):
         """